@@ -6,6 +6,7 @@ components:
     gps commands and yaw
     waypoint following
 """
+import bisect
 import numpy as np
 from frame_utils import euler2RM
 import math
@@ -13,12 +14,20 @@ from math import sin, cos, tan, sqrt
 
 DRONE_MASS_KG = 0.5
 GRAVITY = -9.81
-MOI = np.array([0.005, 0.005, 0.01])
+MOI_TUPLE = (0.005, 0.005, 0.01)
+MOI = np.array(MOI_TUPLE)
 MAX_THRUST = 10.0
 MAX_TORQUE = 1.0
 
+
 class NonlinearController(object):
 
+    __slots__ = ('z_k_p', 'z_k_d', 'x_k_p', 'x_k_d', 'y_k_p', 'y_k_d',
+                 'k_p_roll', 'k_p_pitch', 'k_p_yaw', 'k_p_p', 'k_p_q', 'k_p_r', 'g',
+                 '_out_lat', '_out_rpc', '_out_body',
+                 '_last_attitude', '_last_R',
+                 '_traj_source', '_traj_times', '_traj_positions', '_traj_velocities')
+
     def __init__(self,
                 z_k_p=9.0, 
                 z_k_d=4.8, 
@@ -49,26 +58,42 @@ class NonlinearController(object):
         self.k_p_q = k_p_q
         self.k_p_r = k_p_r
         self.g= 9.81
+        self._out_lat = np.empty(2)
+        self._out_rpc = np.empty(2)
+        self._out_body = np.empty(3)
+        self._last_attitude = None
+        self._last_R = None
+        self._traj_source = None
+        self._traj_times = None
+        self._traj_positions = None
+        self._traj_velocities = None
 
         return    
+
+    def _rotation(self, attitude):
+        """Rotation matrix entries (r00, r01, r02, r10, r11, r12, r22) for attitude,
+        reused while the attitude is unchanged. The controllers never read r20 or r21."""
+        roll, pitch, yaw = float(attitude[0]), float(attitude[1]), float(attitude[2])
+        t = (roll, pitch, yaw)
+        if t == self._last_attitude:
+            return self._last_R
+        cr = cos(roll)
+        sr = sin(roll)
+        cp = cos(pitch)
+        sp = sin(pitch)
+        cy = cos(yaw)
+        sy = sin(yaw)
+
+        R = (cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr,
+             sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr,
+             cp * cr)
+        self._last_attitude = t
+        self._last_R = R
+        return R
+
     def R(self,attitude):
-            
         """attitude: the vehicle's current attitude, 3 element numpy array (roll, pitch, yaw) in radians"""
-        
-        r_x = np.array([[1, 0, 0],
-                    [0, cos(attitude[0]), -sin(attitude[0])],
-                    [0, sin(attitude[0]), cos(attitude[0])]])
-    
-        r_y = np.array([[cos(attitude[1]), 0, sin(attitude[1])],
-                        [0, 1, 0],
-                        [-sin(attitude[1]), 0, cos(attitude[1])]])
-        
-        r_z = np.array([[cos(attitude[2]), -sin(attitude[2]), 0],
-                        [sin(attitude[2]), cos(attitude[2]), 0],
-                        [0,0,1]])
-        
-        r = np.matmul(r_z,np.matmul(r_y,r_x))
-        return r
+        return euler2RM(attitude[0], attitude[1], attitude[2])
     def trajectory_control(self, position_trajectory, yaw_trajectory, time_trajectory, current_time):
         """Generate a commanded position, velocity and yaw based on the trajectory
         
@@ -79,45 +104,38 @@ class NonlinearController(object):
             current_time: float corresponding to the current time in seconds
             
         Returns: tuple (commanded position, commanded velocity, commanded yaw)
+
+        The position and time lists are converted once and reused until a different
+        list object is passed, so load a new trajectory instead of editing one in place.
+        The commanded velocity is a view into that cached data and must not be modified.
                 
         """
 
-        ind_min = np.argmin(np.abs(np.array(time_trajectory) - current_time))
-        time_ref = time_trajectory[ind_min]
-        
-        
-        if current_time < time_ref:
-            position0 = position_trajectory[ind_min - 1]
-            position1 = position_trajectory[ind_min]
-            
-            time0 = time_trajectory[ind_min - 1]
-            time1 = time_trajectory[ind_min]
-            yaw_cmd = yaw_trajectory[ind_min - 1]
-            
-        else:
-            yaw_cmd = yaw_trajectory[ind_min]
-            if ind_min >= len(position_trajectory) - 1:
-                position0 = position_trajectory[ind_min]
-                position1 = position_trajectory[ind_min]
-                
-                time0 = 0.0
-                time1 = 1.0
-            else:
-
-                position0 = position_trajectory[ind_min]
-                position1 = position_trajectory[ind_min + 1]
-                time0 = time_trajectory[ind_min]
-                time1 = time_trajectory[ind_min + 1]
-            
-        position_cmd = (position1 - position0) * \
-                        (current_time - time0) / (time1 - time0) + position0
-        velocity_cmd = (position1 - position0) / (time1 - time0)
+        if self._traj_source is None or self._traj_source[0] is not position_trajectory \
+                or self._traj_source[1] is not time_trajectory:
+            self._traj_source = (position_trajectory, time_trajectory)
+            times = np.asarray(time_trajectory, dtype=np.float64)
+            positions = np.asarray(position_trajectory, dtype=np.float64)
+            # segment k runs from point k to k + 1, the last point holds position
+            velocities = np.zeros_like(positions)
+            velocities[:-1] = (positions[1:] - positions[:-1]) * (1.0 / (times[1:] - times[:-1]))[:, None]
+            self._traj_times = times
+            self._traj_positions = positions
+            self._traj_velocities = velocities
+        times = self._traj_times
+        positions = self._traj_positions
+
+        # last point at or before current_time, the first segment before the start
+        k = max(bisect.bisect_right(time_trajectory, current_time) - 1, 0)
+        yaw_cmd = yaw_trajectory[k]
+        velocity_cmd = self._traj_velocities[k]
+        position_cmd = positions[k] + velocity_cmd * (current_time - times[k])
         
         
         return (position_cmd, velocity_cmd, yaw_cmd)
     
     def lateral_position_control(self, local_position_cmd, local_velocity_cmd, local_position, local_velocity,
-                               acceleration_ff = np.array([0.0, 0.0])):
+                               acceleration_ff = None):
         """Generate horizontal acceleration commands for the vehicle in the local frame
 
         Args:
@@ -125,32 +143,24 @@ class NonlinearController(object):
             local_velocity_cmd: desired 2D velocity in local frame [north_velocity, east_velocity]
             local_position: vehicle position in the local frame [north, east]
             local_velocity: vehicle velocity in the local frame [north_velocity, east_velocity]
-            acceleration_cmd: feedforward acceleration command
+            acceleration_ff: feedforward acceleration command [north, east], None for no feedforward
             
         Returns: desired vehicle 2D acceleration in the local frame [north, east]
-        """
-        x_err = local_position_cmd[0] - local_position[0]
-        x_err_dot = local_velocity_cmd[0] - local_velocity[0]
-
-        p_term_x = self.x_k_p * x_err
-        d_term_x = self.x_k_d * x_err_dot
-
-        x_dot_dot_command = p_term_x + d_term_x + acceleration_ff[0]
-        b_x_c = x_dot_dot_command
-        
-        
-        y_err = local_position_cmd[1] - local_position[1]
-        y_err_dot = local_velocity_cmd[1] - local_velocity[1]
 
-        p_term_y = self.y_k_p * y_err
-        d_term_y = self.y_k_d * y_err_dot
-
-        y_dot_dot_command = p_term_y + d_term_y + acceleration_ff[1]
-        
-        b_y_c = y_dot_dot_command       
-        
+        The returned array is reused by the next call, copy it to keep the value.
+        """
+        b_x_c = self.x_k_p * (local_position_cmd[0] - local_position[0])
+        b_x_c += self.x_k_d * (local_velocity_cmd[0] - local_velocity[0])
+        b_y_c = self.y_k_p * (local_position_cmd[1] - local_position[1])
+        b_y_c += self.y_k_d * (local_velocity_cmd[1] - local_velocity[1])
+        if acceleration_ff is not None:
+            b_x_c += acceleration_ff[0]
+            b_y_c += acceleration_ff[1]
 
-        return np.array([b_x_c,b_y_c])
+        out = self._out_lat
+        out[0] = b_x_c
+        out[1] = b_y_c
+        return out
     
     def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude, acceleration_ff=0.0):
         """Generate vertical acceleration (thrust) command
@@ -165,17 +175,22 @@ class NonlinearController(object):
             
         Returns: thrust command for the vehicle (+up)
         """
-        rot_mat = euler2RM(attitude[0],attitude[1],attitude[2])
+        z_k_p, z_k_d = self.z_k_p, self.z_k_d
+        r22 = self._rotation(attitude)[6]
         z_err = altitude_cmd - altitude
         z_err_dot = vertical_velocity_cmd - vertical_velocity
-        b_z = rot_mat[2,2]
 
-        p_term = self.z_k_p * z_err
-        d_term = self.z_k_d * z_err_dot
+        p_term = z_k_p * z_err
+        d_term = z_k_d * z_err_dot
 
-        u_1_bar = p_term + d_term + acceleration_ff
-        
-        c = (u_1_bar - self.g)/b_z
+        u_1_bar = p_term + d_term
+        if acceleration_ff != 0.0:
+            u_1_bar += acceleration_ff
+
+        # with the thrust axis horizontal no thrust reaches the vertical, command the maximum
+        if r22 == 0.0:
+            return MAX_THRUST
+        c = (u_1_bar - self.g) / r22
 
         return c
         
@@ -189,29 +204,31 @@ class NonlinearController(object):
             thrust_cmd: vehicle thruts command in Newton
             
         Returns: 2-element numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
+
+        The returned array is reused by the next call, copy it to keep the value.
         """
-        c = -thrust_cmd/DRONE_MASS_KG
-        rot_mat = euler2RM(attitude[0],attitude[1],attitude[2])
-        b_x = rot_mat[0,2]
+        k_p_roll, k_p_pitch = self.k_p_roll, self.k_p_pitch
+        acceleration_x, acceleration_y = float(acceleration_cmd[0]), float(acceleration_cmd[1])
+        r00, r01, r02, r10, r11, r12, r22 = self._rotation(attitude)
+        out = self._out_rpc
+        # without thrust, or with the thrust axis horizontal, tilting cannot produce the
+        # commanded acceleration, so command zero roll and pitch rates
+        if thrust_cmd == 0.0 or r22 == 0.0:
+            out[0] = 0.0
+            out[1] = 0.0
+            return out
+        inv_c = -DRONE_MASS_KG / thrust_cmd
 
-        b_x_err = (acceleration_cmd[0]/c) - b_x
-        b_x_p_term = self.k_p_roll * b_x_err
-        
-        b_y = rot_mat[1,2]
+        b_x_err = (acceleration_x * inv_c) - r02
+        b_x_commanded_dot = k_p_roll * b_x_err
 
-        b_y_err = (acceleration_cmd[1]/c) - b_y  
-        b_y_p_term = self.k_p_pitch * b_y_err
-        
-        b_x_commanded_dot = b_x_p_term
-        b_y_commanded_dot = b_y_p_term
-        
-        rot_mat1=np.array([[rot_mat[1,0],-rot_mat[0,0]],[rot_mat[1,1],-rot_mat[0,1]]])/rot_mat[2,2]
-        
-        rot_rate = np.matmul(rot_mat1,np.array([b_x_commanded_dot,b_y_commanded_dot]).T)
-        p_c = rot_rate[0]
-        q_c = rot_rate[1]
+        b_y_err = (acceleration_y * inv_c) - r12
+        b_y_commanded_dot = k_p_pitch * b_y_err
 
-        return np.array([p_c, q_c])
+        inv_r22 = 1.0 / r22
+        out[0] = inv_r22 * (r10 * b_x_commanded_dot - r00 * b_y_commanded_dot)
+        out[1] = inv_r22 * (r11 * b_x_commanded_dot - r01 * b_y_commanded_dot)
+        return out
     
     def body_rate_control(self, body_rate_cmd, body_rate):
         """ Generate the roll, pitch, yaw moment commands in the body frame
@@ -221,19 +238,14 @@ class NonlinearController(object):
             body_rate: 3-element numpy array (p,q,r) in radians/second^2
             
         Returns: 3-element numpy array, desired roll moment, pitch moment, and yaw moment commands in Newtons*meters
-        """
-        p_err= body_rate_cmd[0] - body_rate[0] 
-        u_bar_p = self.k_p_p * p_err*MOI[0]
-        
-        q_err= body_rate_cmd[1] - body_rate[1] 
-        u_bar_q = self.k_p_q * q_err*MOI[1]
-
-        r_err= body_rate_cmd[2] - body_rate[2]
-        u_bar_r = self.k_p_r * r_err*MOI[1]
-        
-
 
-        return np.array([u_bar_p, u_bar_q, u_bar_r])
+        The returned array is reused by the next call, copy it to keep the value.
+        """
+        out = self._out_body
+        out[0] = self.k_p_p * (body_rate_cmd[0] - body_rate[0]) * MOI_TUPLE[0]
+        out[1] = self.k_p_q * (body_rate_cmd[1] - body_rate[1]) * MOI_TUPLE[1]
+        out[2] = self.k_p_r * (body_rate_cmd[2] - body_rate[2]) * MOI_TUPLE[1]
+        return out
     
     def yaw_control(self, yaw_cmd, yaw):
         """ Generate the target yawrate
@@ -244,8 +256,69 @@ class NonlinearController(object):
         
         Returns: target yawrate in radians/sec
         """
-        psi_err = yaw_cmd - yaw
+        # wrap to [-pi, pi) so the vehicle turns the short way round
+        psi_err = (yaw_cmd - yaw + math.pi) % (2 * math.pi) - math.pi
         r_c = self.k_p_yaw * psi_err
 
         return r_c
+
+    def altitude_control_batch(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                               acceleration_ff=0.0):
+        """Vectorised altitude_control over N recorded states, e.g. when replaying a flight log
+
+        Args:
+            altitude_cmd: N desired vertical positions (+up)
+            vertical_velocity_cmd: N desired vertical velocities (+up)
+            altitude: N vehicle vertical positions (+up)
+            vertical_velocity: N vehicle vertical velocities (+up)
+            attitude: Nx3 numpy array of (roll, pitch, yaw) in radians
+            acceleration_ff: feedforward acceleration command (+up), scalar or N values
+
+        Returns: N-element numpy array of thrust commands (+up)
+        """
+        z_k_p, z_k_d = self.z_k_p, self.z_k_d
+        attitude = np.asarray(attitude, dtype=np.float64)
+        c = np.cos(attitude[:, 0:2])
+        r22 = c[:, 0] * c[:, 1]
+
+        u_1_bar = z_k_p * (np.asarray(altitude_cmd) - altitude)
+        u_1_bar = u_1_bar + z_k_d * (np.asarray(vertical_velocity_cmd) - vertical_velocity) + acceleration_ff
+
+        return (u_1_bar - self.g) / r22
+
+    def roll_pitch_controller_batch(self, acceleration_cmd, attitude, thrust_cmd):
+        """Vectorised roll_pitch_controller over N recorded states
+
+        Args:
+            acceleration_cmd: Nx2 numpy array of (north_acceleration_cmd, east_acceleration_cmd) in m / s^2
+            attitude: Nx3 numpy array of (roll, pitch, yaw) in radians
+            thrust_cmd: N vehicle thrust commands in Newton
+
+        Returns: Nx2 numpy array of rollrate (p) and pitchrate (q) commands in radians / s
+        """
+        k_p_roll, k_p_pitch = self.k_p_roll, self.k_p_pitch
+        attitude = np.asarray(attitude, dtype=np.float64)
+        acceleration_cmd = np.asarray(acceleration_cmd, dtype=np.float64)
+        s = np.sin(attitude)
+        c = np.cos(attitude)
+        sr, sp, sy = s[:, 0], s[:, 1], s[:, 2]
+        cr, cp, cy = c[:, 0], c[:, 1], c[:, 2]
+
+        r00 = cy * cp
+        r01 = cy * sp * sr - sy * cr
+        r02 = cy * sp * cr + sy * sr
+        r10 = sy * cp
+        r11 = sy * sp * sr + cy * cr
+        r12 = sy * sp * cr - cy * sr
+        r22 = cp * cr
+
+        inv_c = -DRONE_MASS_KG / np.asarray(thrust_cmd, dtype=np.float64)
+        b_x_commanded_dot = k_p_roll * (acceleration_cmd[:, 0] * inv_c - r02)
+        b_y_commanded_dot = k_p_pitch * (acceleration_cmd[:, 1] * inv_c - r12)
+
+        inv_r22 = 1.0 / r22
+        rates = np.empty((len(r22), 2))
+        rates[:, 0] = inv_r22 * (r10 * b_x_commanded_dot - r00 * b_y_commanded_dot)
+        rates[:, 1] = inv_r22 * (r11 * b_x_commanded_dot - r01 * b_y_commanded_dot)
+        return rates
   